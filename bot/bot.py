@@ -1,5 +1,6 @@
 from telegram.ext import Application
 from .handlers import setup_handlers
+from .utils import refresh_all_prices_job, refresh_hot_prices_job
 from django.conf import settings
 
 
@@ -10,6 +11,10 @@ def initialize_bot():
     # Setup command handlers
     setup_handlers(application)
 
+    # Keep the price snapshot warm so handlers never wait on CoinGecko
+    application.job_queue.run_repeating(refresh_hot_prices_job, interval=30, first=0)
+    application.job_queue.run_repeating(refresh_all_prices_job, interval=600, first=5)
+
     return application
 
 
@@ -1,39 +1,42 @@
+from asgiref.sync import sync_to_async
 from telegram import Update
-from telegram.ext import CallbackContext, CommandHandler, MessageHandler, filters
+from telegram.ext import CallbackContext, MessageHandler, filters
 from wallet.services import get_user_transactions, execute_crypto_swap
-from wallet.utils import get_user_wallet
-from exchange.utils import get_price_data
+from wallet.utils import get_user_wallet, get_wallet_balances
+from .utils import get_cached_price_data, log_swap
 
 class TelegramBotHandlers:
     @staticmethod
-    def start(update: Update, context: CallbackContext):
+    async def start(update: Update, context: CallbackContext):
         """Handle /start command"""
         user = update.effective_user
         # Create or get user wallet
-        wallet = get_user_wallet(str(user.id))
-        update.message.reply_text(f"Welcome {user.first_name}! Your wallet is ready.")
+        wallet = await sync_to_async(get_user_wallet)(str(user.id))
+        await update.message.reply_text(f"Welcome {user.first_name}! Your wallet is ready.")
 
     @staticmethod
-    def balance(update: Update, context: CallbackContext):
+    async def balance(update: Update, context: CallbackContext):
         """Show user's wallet balance"""
         user = update.effective_user
-        wallet = get_user_wallet(str(user.id))
+        balances = await sync_to_async(get_wallet_balances)(str(user.id))
         
         balance_text = "\n".join([
             f"{currency}: {balance}" 
-            for currency, balance in wallet.balance.items()
+            for currency, balance in balances.items()
         ]) or "No balance available."
         
-        update.message.reply_text(f"Your current balances:\n{balance_text}")
+        await update.message.reply_text(f"Your current balances:\n{balance_text}")
 
     @staticmethod
-    def transactions(update: Update, context: CallbackContext):
+    async def transactions(update: Update, context: CallbackContext):
         """Show user's recent transactions"""
         user = update.effective_user
-        transactions = get_user_transactions(str(user.id), limit=5)
+        # Evaluate the queryset in the sync thread, ORM access is not async safe
+        transactions = await sync_to_async(
+            lambda: list(get_user_transactions(str(user.id), limit=5)))()
         
         if not transactions:
-            update.message.reply_text("No transactions found.")
+            await update.message.reply_text("No transactions found.")
             return
 
         transaction_text = "\n\n".join([
@@ -43,10 +46,10 @@ class TelegramBotHandlers:
             for t in transactions
         ])
         
-        update.message.reply_text(f"Your recent transactions:\n{transaction_text}")
+        await update.message.reply_text(f"Your recent transactions:\n{transaction_text}")
 
     @staticmethod
-    def swap_currency(update: Update, context: CallbackContext):
+    async def swap_currency(update: Update, context: CallbackContext):
         """Handle currency swap"""
         user = update.effective_user
         
@@ -56,32 +59,57 @@ class TelegramBotHandlers:
             from_currency = context.args[1].upper()
             to_currency = context.args[2].upper()
 
-            # Get current price data
-            price_data = get_price_data()
+            # Get current price data from the background refreshed snapshot
+            price_data = await get_cached_price_data()
 
             # Execute swap
-            result = execute_crypto_swap(
+            result = await sync_to_async(execute_crypto_swap)(
                 user_id=str(user.id),
                 from_currency=from_currency,
                 to_currency=to_currency,
                 from_amount=amount,
                 price_data=price_data
             )
+            context.application.create_task(log_swap(
+                str(user.id), amount, from_currency, to_currency, result.success))
 
             if result.success:
-                update.message.reply_text(
+                await update.message.reply_text(
                     f"Successfully swapped {amount} {from_currency} to {to_currency}\n"
                     f"Transaction ID: {result.transaction_record.id}"
                 )
             else:
-                update.message.reply_text(f"Swap failed: {result.message}")
+                await update.message.reply_text(f"Swap failed: {result.message}")
 
         except (IndexError, ValueError):
-            update.message.reply_text("Usage: /swap <amount> <from_currency> <to_currency>")
+            await update.message.reply_text("Usage: /swap <amount> <from_currency> <to_currency>")
+
+# Command -> handler, resolved with a single dict lookup per update
+ROUTES = {
+    'start': TelegramBotHandlers.start,
+    'balance': TelegramBotHandlers.balance,
+    'transactions': TelegramBotHandlers.transactions,
+    'swap': TelegramBotHandlers.swap_currency,
+}
+
+
+async def dispatch(update: Update, context: CallbackContext):
+    """Route a /command message to its handler"""
+    message = update.effective_message
+    if message is None or not message.text:
+        return
+    command, *args = message.text.split()
+    # Strip the leading '/', commands addressed to another bot ('@OtherBot') are ignored
+    name, _, bot_username = command[1:].partition('@')
+    if bot_username and bot_username.lower() != (context.bot.username or '').lower():
+        return
+    handler = ROUTES.get(name.lower())
+    if handler:
+        context.args = args
+        await handler(update, context)
+
 
 def setup_handlers(application):
     """Register all bot command handlers"""
-    application.add_handler(CommandHandler('start', TelegramBotHandlers.start))
-    application.add_handler(CommandHandler('balance', TelegramBotHandlers.balance))
-    application.add_handler(CommandHandler('transactions', TelegramBotHandlers.transactions))
-    application.add_handler(CommandHandler('swap', TelegramBotHandlers.swap_currency))
\ No newline at end of file
+    # New messages only, editing an old /swap must not run it again
+    application.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.COMMAND, dispatch))
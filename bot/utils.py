@@ -0,0 +1,42 @@
+import logging
+from asgiref.sync import sync_to_async
+from telegram.ext import CallbackContext
+from exchange.prices import get_price_data, refresh_all_prices, refresh_hot_prices
+
+logger = logging.getLogger(__name__)
+
+# Latest price snapshot, kept warm by the refresh jobs
+PRICE_DATA = {}
+
+
+async def _refresh(refresh):
+    try:
+        price_data = await sync_to_async(refresh)()
+    except Exception:
+        logger.exception("Price refresh failed")
+        return
+    if price_data:
+        PRICE_DATA.update(price_data)
+
+
+async def refresh_hot_prices_job(context: CallbackContext):
+    """Refresh prices of recently traded coins off the response path"""
+    await _refresh(refresh_hot_prices)
+
+
+async def refresh_all_prices_job(context: CallbackContext):
+    """Refresh prices of every listed coin off the response path"""
+    await _refresh(refresh_all_prices)
+
+
+async def get_cached_price_data():
+    """Serve prices from the snapshot, reading the shared cache only before the first refresh"""
+    if not PRICE_DATA:
+        PRICE_DATA.update(await sync_to_async(get_price_data)() or {})
+    return PRICE_DATA
+
+
+async def log_swap(user_id: str, amount, from_currency: str, to_currency: str, success: bool):
+    """Record swap analytics without holding up the reply"""
+    logger.info("swap user=%s %s %s->%s success=%s",
+                user_id, amount, from_currency, to_currency, success)
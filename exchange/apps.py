@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ExchangeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'exchange'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,22 @@
+import time
+from .models import Coin
+
+# Active coin ids only change on admin edits (post_save signal) or load_coins runs
+# (invalidated explicitly), other processes pick changes up within the ttl
+_active_coins = {'ts': 0.0, 'ids': frozenset()}
+
+
+def active_coin_ids(ttl: int = 300) -> frozenset:
+    '''
+    Returns the ids of all active coins, served from memory and refreshed from the DB every ttl seconds.
+    '''
+    now = time.time()
+    if now - _active_coins['ts'] > ttl:
+        _active_coins['ids'] = frozenset(
+            Coin.objects.filter(is_active=True).values_list('id', flat=True))
+        _active_coins['ts'] = now
+    return _active_coins['ids']
+
+
+def invalidate_active_coin_ids():
+    _active_coins['ts'] = 0.0
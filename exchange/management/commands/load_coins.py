@@ -1,8 +1,51 @@
+from ...cache import invalidate_active_coin_ids
 from ...models import Coin, Vs_currencies
-import requests
+from ...utils import REQUEST_TIMEOUT, SESSION
+import codecs
+import json
+from concurrent.futures import ThreadPoolExecutor
 from django.core.management.base import BaseCommand
+from django.db import transaction
 import time
 
+BATCH_SIZE = 1000
+
+
+def iter_json_array(response, chunk_size=64 * 1024):
+    '''
+    Yields the items of a top level JSON array as the response body streams in,
+    so the full payload is never held in memory at once.
+    Raises ValueError if the body ends before the closing bracket.
+    '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    started = False
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        buffer += text.decode(chunk)
+        pos = 0
+        while True:
+            # Skip whitespace and separators between items
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # Item is incomplete, wait for the next chunk
+            yield item
+        buffer = buffer[pos:]
+    raise ValueError("Response ended before the end of the JSON array")
+
 
 class Command(BaseCommand):
     help = 'Load database with supported currencies from CoinGecko API'
@@ -11,33 +54,55 @@ class Command(BaseCommand):
         start_time = time.time()
         coingecko_url = "https://api.coingecko.com/api/v3"
 
-        # Fetch the list of vs_currencies
-        vs_currencies_response = requests.get(
-            f"{coingecko_url}/simple/supported_vs_currencies")
+        # Shared keep-alive session with retries, both lists fetched concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            vs_currencies_future = executor.submit(
+                SESSION.get, f"{coingecko_url}/simple/supported_vs_currencies",
+                timeout=REQUEST_TIMEOUT)
+            coins_future = executor.submit(
+                SESSION.get, f"{coingecko_url}/coins/list",
+                stream=True, timeout=REQUEST_TIMEOUT)
+            vs_currencies_response = vs_currencies_future.result()
+            coins_response = coins_future.result()
+        vs_currencies_response.raise_for_status()
         vs_currencies = vs_currencies_response.json()
-        # Update or create the vs_currencies in the database
-        for vs_currency in vs_currencies:
-            Vs_currencies.objects.update_or_create(
-                currency=vs_currency
-            )
 
-        # Fetch the list of available coins
-        coins_response = requests.get(f"{coingecko_url}/coins/list")
-        coins = coins_response.json()
-        # Update or create the coins in the database
-        for coin in coins:
-            coin_data = {
-                'id': coin['id'],
-                'name': coin['name'],
-                'symbol': coin['symbol'],
-                'is_active': True
-            }
-            Coin.objects.update_or_create(
-                id=coin_data['id'],
-                defaults=coin_data
-            )
+        # Upsert everything in batches instead of one query pair per row
+        Vs_currencies.objects.bulk_create(
+            [Vs_currencies(currency=vs_currency)
+             for vs_currency in vs_currencies],
+            ignore_conflicts=True,
+            batch_size=BATCH_SIZE
+        )
+
+        # Stream the (large) list of available coins, writing as it arrives.
+        # Each batch commits on its own so no write lock is held across the download;
+        # upserts are idempotent, rerun the command if the download is cut short.
+        with coins_response:
+            coins_response.raise_for_status()
+            buffer = []
+            for coin in iter_json_array(coins_response):
+                buffer.append(Coin(id=coin['id'], name=coin['name'],
+                                   symbol=coin['symbol'], is_active=True))
+                if len(buffer) >= BATCH_SIZE:
+                    self._upsert_coins(buffer)
+                    buffer.clear()
+            if buffer:
+                self._upsert_coins(buffer)
+        # bulk_create sends no post_save, so the signal never invalidates the coin cache
+        invalidate_active_coin_ids()
 
         end_time = time.time()
         total_time = end_time - start_time
         self.stdout.write(self.style.SUCCESS(
             f'Successfully loaded currencies from CoinGecko API in {total_time:.2f} seconds'))
+
+    @staticmethod
+    def _upsert_coins(coins):
+        with transaction.atomic():
+            Coin.objects.bulk_create(
+                coins,
+                update_conflicts=True,
+                unique_fields=['id'],
+                update_fields=['name', 'symbol', 'is_active']
+            )
@@ -7,7 +7,7 @@ class Coin(models.Model):
     # e.g., 'bitcoin' for BTC
     id = models.CharField(max_length=50, primary_key=True)
     name = models.CharField(max_length=100)                 # e.g., 'Bitcoin'
-    symbol = models.CharField(max_length=50)                # e.g., 'btc'
+    symbol = models.CharField(max_length=50, db_index=True)  # e.g., 'btc'
     price_usd = models.DecimalField(
         max_digits=20,
         decimal_places=8,
@@ -15,8 +15,7 @@ class Coin(models.Model):
         validators=[MinValueValidator(0.0)],
         help_text="Current price in USD"
     )
-    date_added = models.DateTimeField(
-        auto_now_add=True, db_index=True)
+    date_added = models.DateTimeField(auto_now_add=True)
     last_updated = models.DateTimeField(auto_now=True)
     last_updated.short_description = "Last Updated"
     is_active = models.BooleanField(default=True, db_index=True)
@@ -24,6 +23,10 @@ class Coin(models.Model):
     class Meta:
         verbose_name_plural = "Coins"
         ordering = ['symbol']
+        indexes = [
+            models.Index(fields=['is_active', 'id'], name='coin_active_id_idx'),
+            models.Index(fields=['is_active', 'symbol'], name='coin_active_symbol_idx'),
+        ]
 
     def __str__(self):
         return f"{self.symbol} - {self.name}"
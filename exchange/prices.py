@@ -0,0 +1,95 @@
+import logging
+from datetime import timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List
+import requests
+from django.core.cache import cache
+from django.utils import timezone
+from templates.URLS import Coingecko
+from wallet.models import Transaction
+from .models import Coin
+from .utils import (COINGECKO_BREAKER, CircuitBreaker, CircuitOpenError, _cache_prices,
+                    coingecko_get, to_decimal)
+
+logger = logging.getLogger(__name__)
+
+# Price snapshots are tiered: coins being traded right now are refreshed often,
+# the long tail of listed coins only every few minutes.
+HOT_PRICES_KEY = 'prices_usd:hot'
+ALL_PRICES_KEY = 'prices_usd:all'
+HOT_PRICES_TTL = 60
+ALL_PRICES_TTL = 15 * 60
+HOT_TIER_SIZE = 500
+# Max ids per /simple/price request
+PRICE_BATCH_SIZE = 250
+# The full refresh sends dozens of requests, rate limits it runs into must not
+# open the circuit live swaps go through
+BULK_BREAKER = CircuitBreaker(fail_max=3, reset_timeout=60)
+
+
+def fetch_prices(coin_ids: Iterable[str], vs_currency: str = 'usd',
+                 breaker: CircuitBreaker = COINGECKO_BREAKER) -> Dict[str, Decimal]:
+    '''
+    Fetches prices for many coins from CoinGecko, batching ids into as few requests as possible.
+    Returns a {coin_id: price} dict; coins CoinGecko has no price for, or whose batch
+    failed, are left out.
+    '''
+    coin_ids = list(coin_ids)
+    prices = {}
+    for i in range(0, len(coin_ids), PRICE_BATCH_SIZE):
+        batch = coin_ids[i:i + PRICE_BATCH_SIZE]
+        try:
+            response = coingecko_get(Coingecko.COIN_PRICE, breaker=breaker, params={
+                'ids': ','.join(batch), 'vs_currencies': vs_currency})
+            quotes = response.json(parse_float=Decimal)
+        except CircuitOpenError as e:
+            logger.warning("Price refresh stopped after %d of %d coins: %s", i, len(coin_ids), e)
+            break
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning("Skipping price batch of %d coins: %s", len(batch), e)
+            continue
+        for coin_id, quote in quotes.items():
+            if quote.get(vs_currency) is not None:
+                prices[coin_id] = to_decimal(quote[vs_currency])
+    return prices
+
+
+def hot_coin_ids() -> List[str]:
+    '''Returns the ids of active coins traded in the last day, the top price tier'''
+    since = timezone.now() - timedelta(days=1)
+    traded = set()
+    # order_by() drops the default -timestamp ordering, which would otherwise be selected
+    # by DISTINCT and keep one busy pair from being deduplicated
+    for base, destination in Transaction.objects.filter(timestamp__gte=since).values_list(
+            'base_currency', 'destination_currency').order_by().distinct()[:HOT_TIER_SIZE]:
+        traded.update((base, destination))
+    return list(Coin.objects.filter(is_active=True, id__in=traded)
+                .values_list('id', flat=True)[:HOT_TIER_SIZE])
+
+
+def refresh_hot_prices() -> Dict[str, Decimal]:
+    prices = fetch_prices(hot_coin_ids())
+    # Per-coin keys first, so a size-capped cache culls them before the snapshot
+    _cache_prices(prices, 'usd')
+    cache.set(HOT_PRICES_KEY, prices, HOT_PRICES_TTL)
+    return prices
+
+
+def refresh_all_prices() -> Dict[str, Decimal]:
+    prices = fetch_prices(
+        Coin.objects.filter(is_active=True).values_list('id', flat=True), breaker=BULK_BREAKER)
+    # Per-coin keys first, so a size-capped cache culls them before the snapshot
+    _cache_prices(prices, 'usd')
+    cache.set(ALL_PRICES_KEY, prices, ALL_PRICES_TTL)
+    return prices
+
+
+def get_price_data() -> Dict[str, Decimal]:
+    '''
+    Returns the latest USD price snapshot from the shared cache.
+    Only goes to CoinGecko (for the hot tier) when nothing is cached yet.
+    '''
+    snapshots = cache.get_many([ALL_PRICES_KEY, HOT_PRICES_KEY])
+    if not snapshots:
+        return refresh_hot_prices()
+    return {**snapshots.get(ALL_PRICES_KEY, {}), **snapshots.get(HOT_PRICES_KEY, {})}
@@ -1,15 +1,32 @@
-from typing import Dict, Union
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 from decimal import Decimal
 from dataclasses import dataclass
-from django.shortcuts import get_object_or_404
-from django.db import transaction
-from wallet.models import Transaction, User
-from wallet.utils import get_user_wallet
+from datetime import timedelta
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from wallet.models import Transaction, Wallet, WalletBalance
+from wallet.utils import (credit_balance, credit_wallet, debit_balance, from_units,
+                          get_balances, to_units)
 from .models import Coin
-from .utils import get_coin_price
+from .cache import active_coin_ids
+from .utils import PRICE_CACHE_TTL, get_coin_price, get_coin_prices, normalize_code, to_decimal
 
+logger = logging.getLogger(__name__)
 
-@dataclass
+# Amounts move as whole balance units (8 decimal places), prices carry extra digits
+# for low value coins
+AMOUNT_PLACES = WalletBalance.BALANCE_PLACES
+PRICE_PLACES = 18
+PRICE_SCALE = 10 ** PRICE_PLACES
+ZERO = Decimal(0)
+
+
+@dataclass(slots=True, frozen=True)
 class TransactionResult:
     success: bool
     transaction_record: Union[Transaction, None]
@@ -19,6 +36,184 @@ class TransactionResult:
     error_type: str = None
 
 
+def _validation_error(status: str, message: str) -> TransactionResult:
+    return TransactionResult(
+        success=False,
+        transaction_record=None,
+        status=status,
+        message=message,
+        error_type='ValidationError'
+    )
+
+
+# Results are immutable, so the common validation failures are built once and shared
+ALL_PARAMS_REQUIRED = _validation_error(
+    'invalid_input', "All parameters are required")
+AMOUNT_NOT_A_NUMBER = _validation_error(
+    'invalid_input', "Amount must be a number")
+AMOUNT_NOT_POSITIVE = _validation_error(
+    'invalid_input', "Amount must be positive")
+AMOUNT_TOO_SMALL = _validation_error(
+    'invalid_input', f"Amount is too small, the smallest amount that can move is {from_units(1):f}")
+INVALID_TRANSACTION_TYPE = _validation_error(
+    'invalid_input', "Transaction type must be 'buy' or 'sell'")
+SAME_CURRENCY_PAIR = _validation_error(
+    'invalid_pair', "Cannot swap currency for itself")
+CURRENCY_NOT_SUPPORTED = _validation_error(
+    'unsupported_currency', "Currency not supported")
+SWAP_PRICE_UNAVAILABLE = _validation_error(
+    'price_unavailable', "Price data unavailable for one or both currencies")
+PRICE_UNAVAILABLE = _validation_error(
+    'price_unavailable', "Price data unavailable for the currency")
+
+
+_NUMBER_TYPES = (Decimal, float, int)
+# Failures execution can run into once the input is valid (missing wallet, database
+# errors, amounts too large for the schema), anything else is a bug and propagates
+_EXECUTION_ERRORS = (ObjectDoesNotExist, DatabaseError, ArithmeticError)
+_BUY_SELL = frozenset(('buy', 'sell'))
+
+
+def _is_finite_number(amount) -> bool:
+    if isinstance(amount, Decimal):
+        return amount.is_finite()  # math.isfinite raises on signaling NaNs
+    return isinstance(amount, _NUMBER_TYPES) and math.isfinite(amount)
+
+
+def _validate_swap(user_id, origin_currency_id, destination_currency_id,
+                   origin_amount) -> Optional[TransactionResult]:
+    '''
+    Returns the shared error result for the first failed check, or None.
+    Pure input checks only, whether the coins are supported needs the database.
+    '''
+    if not (user_id and origin_currency_id and destination_currency_id and origin_amount):
+        return ALL_PARAMS_REQUIRED
+    if not _is_finite_number(origin_amount):
+        return AMOUNT_NOT_A_NUMBER
+    if origin_amount <= 0:
+        return AMOUNT_NOT_POSITIVE
+    if not (isinstance(origin_currency_id, str) and isinstance(destination_currency_id, str)):
+        return CURRENCY_NOT_SUPPORTED
+    if origin_currency_id == destination_currency_id:
+        return SAME_CURRENCY_PAIR
+    return None
+
+
+def _validate_trade(user_id, cryptocurrency_id, amount,
+                    transaction_type) -> Optional[TransactionResult]:
+    '''
+    Returns the shared error result for the first failed check, or None.
+    Pure input checks only, whether the coin is supported needs the database.
+    '''
+    if not (user_id and cryptocurrency_id and amount and transaction_type):
+        return ALL_PARAMS_REQUIRED
+    if not _is_finite_number(amount):
+        return AMOUNT_NOT_A_NUMBER
+    if amount <= 0:
+        return AMOUNT_NOT_POSITIVE
+    if not isinstance(transaction_type, str) or normalize_code(transaction_type) not in _BUY_SELL:
+        return INVALID_TRANSACTION_TYPE
+    if not isinstance(cryptocurrency_id, str):
+        return CURRENCY_NOT_SUPPORTED
+    return None
+
+
+def _get_wallet(user_id: str) -> Wallet:
+    '''Returns a user's wallet with just the keys the balance updates and records need'''
+    return Wallet.objects.only('id', 'user_id').get(user__user_id=user_id)
+
+
+def _record_transaction(**fields) -> Transaction:
+    '''Inserts a transaction record, bulk_create skips the model signals nobody listens to'''
+    return Transaction.objects.bulk_create([Transaction(**fields)])[0]
+
+
+def _log_completed(transaction_record: Transaction):
+    logger.info("Completed %s #%s for user %s: %s", transaction_record.transaction_type,
+                transaction_record.pk, transaction_record.user_id,
+                transaction_record.transaction_details)
+
+
+def _exchange(wallet: Wallet, base_currency: str, base_units: int,
+              destination_currency: str, destination_units: int,
+              **record) -> Tuple[Optional[Transaction], Dict[str, Decimal]]:
+    '''
+    Moves base_units out of one balance and destination_units into another, and records
+    exactly those amounts, as one unit of work. Shared by swaps, buys and sells.
+    Returns (the transaction record, or None if funds were insufficient; both balances afterwards)
+    '''
+    transaction_record = None
+    with transaction.atomic():
+        if debit_balance(wallet.id, base_currency, base_units):
+            credit_balance(wallet.id, destination_currency, destination_units)
+            transaction_record = _record_transaction(
+                user_id=wallet.user_id,
+                wallet=wallet,
+                base_currency=base_currency,
+                base_amount=from_units(base_units),
+                destination_currency=destination_currency,
+                destination_amount=from_units(destination_units),
+                status='completed',
+                **record
+            )
+            # Side effects run once the transaction has committed, outside the atomic block
+            transaction.on_commit(partial(_log_completed, transaction_record))
+    return transaction_record, get_balances(wallet.id, (base_currency, destination_currency))
+
+
+def _price_units(price: Decimal) -> int:
+    '''A price in units of 10^-PRICE_PLACES USD, 0 for prices too small to represent'''
+    return int(to_decimal(price).scaleb(PRICE_PLACES))
+
+
+def _swap_units(origin_units: int, origin_usd_price: Decimal,
+                destination_usd_price: Decimal) -> Tuple[int, int]:
+    '''
+    Returns (destination_units, rate_units) for a swap of origin_units, both in balance
+    units and rounded down, so the user never receives more than the origin is worth.
+    '''
+    origin_price = _price_units(origin_usd_price)
+    destination_price = _price_units(destination_usd_price)
+    if not (origin_price and destination_price):
+        raise ValueError(
+            f"Prices below 1e-{PRICE_PLACES} USD can't be swapped: "
+            f"{origin_usd_price}, {destination_usd_price}")
+    return (origin_units * origin_price // destination_price,
+            origin_price * 10 ** AMOUNT_PLACES // destination_price)
+
+
+def _usd_units(crypto_units: int, price: Decimal, round_up: bool) -> int:
+    '''USD units crypto_units are worth at price, rounded up when the user pays them'''
+    if round_up:
+        return -(-crypto_units * _price_units(price) // PRICE_SCALE)
+    return crypto_units * _price_units(price) // PRICE_SCALE
+
+
+def _swap_amounts(origin_amount: Decimal, origin_usd_price: Decimal,
+                  destination_usd_price: Decimal) -> Tuple[Decimal, Decimal]:
+    '''
+    Returns (destination_amount, rate) for a swap, computed in balance units
+    exactly as an executed swap would be, converting back to Decimal only at the end.
+    '''
+    destination_units, rate_units = _swap_units(
+        to_units(origin_amount), origin_usd_price, destination_usd_price)
+    return from_units(destination_units), from_units(rate_units)
+
+
+def simulate_many_swaps(swaps: Iterable[Tuple[Union[Decimal, float, int, str], Decimal, Decimal]]
+                        ) -> List[Tuple[Decimal, Decimal]]:
+    '''
+    Prices a batch of historical swaps (backtests/replays) without touching wallets or the DB.
+    Each item is (origin_amount, origin_usd_price, destination_usd_price).
+    Returns a list of (destination_amount, rate) in the same order.
+    Raises ValueError for a price too small to represent (below 1e-PRICE_PLACES USD).
+    '''
+    return [
+        _swap_amounts(to_decimal(amount), origin_usd_price, destination_usd_price)
+        for amount, origin_usd_price, destination_usd_price in swaps
+    ]
+
+
 # For future reference: All transactions are swaps. A swap is a transaction where one currency is exchanged for another.
 # we only support usd as the base currency for now
 
@@ -40,137 +235,74 @@ def simulate_and_execute_swap(user_id: str, origin_currency_id: str, destination
     Raises:
         Unexpected Error: If an error occurs during the swap transaction  
     """
-    try:
-        # Input validation
-        if not all([user_id, origin_currency_id, destination_currency_id, origin_amount]):
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='invalid_input',
-                message="All parameters are required",
-                error_type='ValidationError'
-            )
-        if not isinstance(origin_amount, (Decimal, float, int)):
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='invalid_input',
-                message="Amount must be a number",
-                error_type='ValidationError'
-            )
-        if origin_amount <= 0:
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='invalid_input',
-                message="Amount must be positive",
-                error_type='ValidationError'
-            )
-        if origin_currency_id == destination_currency_id:
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='invalid_pair',
-                message="Cannot swap currency for itself",
-                error_type='ValidationError'
-            )
+    error = _validate_swap(user_id, origin_currency_id,
+                           destination_currency_id, origin_amount)
+    if error:
+        return error
+    # Converted to units once, the same ints are debited, credited and recorded
+    origin_units = to_units(to_decimal(origin_amount))
 
-        supported_coins = Coin.objects.filter(
-            is_active=True).values_list('id', flat=True)
-        if origin_currency_id not in supported_coins:
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='unsupported_currency',
-                message="Currency not supported",
-                error_type='ValidationError'
-            )
-        if destination_currency_id not in supported_coins:
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='unsupported_currency',
-                message="Currency not supported",
-                error_type='ValidationError'
-            )
-        origin_amount = Decimal(str(origin_amount))
+    try:
+        supported_coins = active_coin_ids()
+        if origin_currency_id not in supported_coins or \
+                destination_currency_id not in supported_coins:
+            return CURRENCY_NOT_SUPPORTED
 
         # Get price rates
-        origin_usd_price = get_coin_price(origin_currency_id)
-        destination_usd_price = get_coin_price(destination_currency_id)
+        prices = get_coin_prices([origin_currency_id, destination_currency_id])
+        origin_usd_price = prices.get(origin_currency_id)
+        destination_usd_price = prices.get(destination_currency_id)
         # Validate price data
-        if not (origin_usd_price and destination_usd_price):
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='price_unavailable',
-                message="Price data unavailable for one or both currencies",
-                error_type='ValidationError'
-            )
+        # Prices too small to represent count as unavailable
+        if not (origin_usd_price and destination_usd_price and
+                _price_units(origin_usd_price) and _price_units(destination_usd_price)):
+            return SWAP_PRICE_UNAVAILABLE
 
         # Calculate swap amounts
-        total_swap_value = origin_amount * origin_usd_price
-        destination_amount = total_swap_value / destination_usd_price
-        rate = destination_amount / origin_amount
-
-        # Execute the swap as a single unit of work (transaction)
-        with transaction.atomic():
-            user = get_object_or_404(User, user_id=user_id)
-            wallet = get_user_wallet(user_id)
-
-            # Check if user has sufficient balance
-            current_destination_balance = Decimal(
-                str(wallet.balance.get(destination_currency_id, '0')))
-            current_origin_balance = Decimal(
-                str(wallet.balance.get(origin_currency_id, '0')))
-            if current_origin_balance < origin_amount:
-                return TransactionResult(
-                    success=False,
-                    transaction_record=None,
-                    status='insufficient_funds',
-                    message=f"Insufficient {origin_currency_id} balance. Current balance is {current_origin_balance}",
-                    error_type='InsufficientFundsError'
-                )
-
-            # (Perform swap) Update wallet balances
-            wallet.balance[origin_currency_id] = str(
-                current_origin_balance - origin_amount)
-            wallet.balance[destination_currency_id] = str(
-                current_destination_balance + destination_amount)
-            wallet.save()
-
-            # Record the swap transaction
-            transaction_record = Transaction.objects.create(
-                user=user,
-                wallet=wallet,
-                base_currency=origin_currency_id,
-                base_amount=origin_amount,
-                destination_currency=destination_currency_id,
-                destination_amount=destination_amount,
-                rate=rate,
-                swap_destination_usd_rate=destination_usd_price,
-                swap_origin_usd_rate=origin_usd_price,
-                transaction_type='swap',
-                status='completed',
-                transaction_details=f"Swapped {origin_amount} {origin_currency_id} "
-                f"for {destination_amount} {destination_currency_id}"
-            )
+        destination_units, rate_units = _swap_units(
+            origin_units, origin_usd_price, destination_usd_price)
+        if not (origin_units and destination_units):
+            return AMOUNT_TOO_SMALL
+        origin_amount = from_units(origin_units)
+        destination_amount = from_units(destination_units)
+
+        # Execute the swap as a single unit of work (transaction), the balance
+        # check and debit are one conditional UPDATE
+        transaction_record, balances = _exchange(
+            _get_wallet(user_id),
+            origin_currency_id, origin_units,
+            destination_currency_id, destination_units,
+            rate=from_units(rate_units),
+            swap_destination_usd_rate=destination_usd_price,
+            swap_origin_usd_rate=origin_usd_price,
+            transaction_type='swap',
+            transaction_details=f"Swapped {origin_amount:f} {origin_currency_id} "
+            f"for {destination_amount:f} {destination_currency_id}"
+        )
+
+        if transaction_record is None:
             return TransactionResult(
-                success=True,
-                transaction_record=transaction_record,
-                status='completed',
-                message=(
-                    f"Successfully swapped {origin_amount} {origin_currency_id} "
-                    f"for {destination_amount:.8f} {destination_currency_id}"
-                ),
-                final_balances={
-                    origin_currency_id: wallet.balance[origin_currency_id],
-                    destination_currency_id: wallet.balance[destination_currency_id]
-                }
+                success=False,
+                transaction_record=None,
+                status='insufficient_funds',
+                message=f"Insufficient {origin_currency_id} balance. Current balance is {balances.get(origin_currency_id, ZERO)}",
+                error_type='InsufficientFundsError'
             )
-    except Exception as e:
-        # Log unexpected error here
-        print(f"Unexpected Error: {str(e)}")
+        return TransactionResult(
+            success=True,
+            transaction_record=transaction_record,
+            status='completed',
+            message=(
+                f"Successfully swapped {origin_amount:f} {origin_currency_id} "
+                f"for {destination_amount:.8f} {destination_currency_id}"
+            ),
+            final_balances={
+                origin_currency_id: balances.get(origin_currency_id, ZERO),
+                destination_currency_id: balances[destination_currency_id]
+            }
+        )
+    except _EXECUTION_ERRORS as e:
+        logger.exception("Unexpected error during swap for user %s", user_id)
         return TransactionResult(
             success=False,
             transaction_record=None,
@@ -180,6 +312,92 @@ def simulate_and_execute_swap(user_id: str, origin_currency_id: str, destination
         )
 
 
+def _execute_buy(user_id: str, coin: Coin, units: int, price: Decimal) -> TransactionResult:
+    '''Buys units of coin with usd from the user's wallet'''
+    cryptocurrency_id = coin.id
+    usd_units = _usd_units(units, price, round_up=True)
+    if not usd_units:
+        return AMOUNT_TOO_SMALL
+    amount = from_units(units)
+    usd_value = from_units(usd_units)
+    transaction_record, balances = _exchange(
+        _get_wallet(user_id), 'usd', usd_units, cryptocurrency_id, units,
+        rate=price,
+        transaction_type='buy',
+        transaction_details=f"Bought {amount:f} {cryptocurrency_id} at {price} USD"
+    )
+    current_usd_balance = balances.get('usd', ZERO)
+    current_crypto_balance = balances.get(cryptocurrency_id, ZERO)
+
+    if transaction_record is None:
+        return TransactionResult(
+            success=False,
+            transaction_record=None,
+            status='insufficient_funds',
+            message=f" Need: {usd_value:f}(USD) to buy {amount:f}({coin.name}), Have: {current_usd_balance}(USD)",
+            final_balances={
+                'usd': current_usd_balance,
+                cryptocurrency_id: current_crypto_balance
+            },
+            error_type='InsufficientFundsError'
+        )
+    return TransactionResult(
+        success=True,
+        transaction_record=transaction_record,
+        status='completed',
+        message=f"Successfully bought {amount:f} {cryptocurrency_id} at {price} USD",
+        final_balances={
+            'usd': current_usd_balance,
+            cryptocurrency_id: current_crypto_balance
+        }
+    )
+
+
+def _execute_sell(user_id: str, coin: Coin, units: int, price: Decimal) -> TransactionResult:
+    '''Sells units of coin for usd from the user's wallet'''
+    cryptocurrency_id = coin.id
+    usd_units = _usd_units(units, price, round_up=False)
+    if not usd_units:
+        return AMOUNT_TOO_SMALL
+    amount = from_units(units)
+    usd_value = from_units(usd_units)
+    transaction_record, balances = _exchange(
+        _get_wallet(user_id), cryptocurrency_id, units, 'usd', usd_units,
+        rate=price,
+        transaction_type='sell',
+        transaction_details=f"Sold {amount:f} {cryptocurrency_id} at {price} USD"
+    )
+    current_usd_balance = balances.get('usd', ZERO)
+    current_crypto_balance = balances.get(cryptocurrency_id, ZERO)
+
+    if transaction_record is None:
+        return TransactionResult(
+            success=False,
+            transaction_record=None,
+            status='insufficient_funds',
+            message=f"Insufficient {cryptocurrency_id} balance. Need: {amount:f}{cryptocurrency_id}, Have: {current_crypto_balance}",
+            final_balances={
+                'usd': current_usd_balance,
+                cryptocurrency_id: current_crypto_balance
+            },
+            error_type='InsufficientFundsError'
+        )
+    return TransactionResult(
+        success=True,
+        transaction_record=transaction_record,
+        status='completed',
+        message=f"Successfully sold {amount:f} {cryptocurrency_id} at {price} USD",
+        final_balances={
+            'usd': current_usd_balance,
+            cryptocurrency_id: current_crypto_balance
+        }
+    )
+
+
+# Straight-line executor per (validated) transaction type
+_DISPATCH = {'buy': _execute_buy, 'sell': _execute_sell}
+
+
 def simulate_and_execute_buy_sell(
         user_id: str,
         cryptocurrency_id: str,
@@ -197,165 +415,39 @@ def simulate_and_execute_buy_sell(
     Returns:
         TransactionResult object containing execution status and details
     """
+    error = _validate_trade(user_id, cryptocurrency_id,
+                            amount, transaction_type)
+    if error:
+        return error
+    cryptocurrency_id = normalize_code(cryptocurrency_id)
+    # Converted to units once, the same ints are debited, credited and recorded
+    units = to_units(to_decimal(amount))
+    if not units:
+        return AMOUNT_TOO_SMALL
+    transaction_type = normalize_code(transaction_type)
+
     try:
-        # Input validation
-        if not all([user_id, cryptocurrency_id, amount, transaction_type]):
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='invalid_input',
-                message='All parameters are required',
-                error_type='ValidationError'
-            )
-        if not isinstance(amount, (Decimal, float, int)):
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='invalid_input',
-                message='Amount must be a number',
-                error_type='ValidationError'
-            )
-        amount = Decimal(str(amount))
-        if amount <= 0:
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='invalid_input',
-                message='Amount must be positive',
-                error_type='ValidationError'
-            )
-        transaction_type = transaction_type.lower()
-        if transaction_type not in ['buy', 'sell']:
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='invalid_input',
-                message="Transaction type must be 'buy' or 'sell'",
-                error_type='ValidationError'
-            )
-        cryptocurrency_id = cryptocurrency_id.lower()
+        if cryptocurrency_id not in active_coin_ids():
+            return CURRENCY_NOT_SUPPORTED
         try:
-            coin = Coin.objects.get(id=cryptocurrency_id)
-        except:
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='unsupported_currency',
-                message="Currency not supported",
-                error_type='ValidationError'
-            )
-        # if cryptocurrency_id not in Coin.objects.filter(is_active=True).values_list('id', flat=True):
-
-        price = get_coin_price(cryptocurrency_id)
-        # price = 27000.33
-        print(f"coin price is {price}")
-        if not price:
-            return TransactionResult(
-                success=False,
-                transaction_record=None,
-                status='price_unavailable',
-                message="Price data unavailable for the currency",
-                error_type='ValidationError'
-            )
-        usd_value = amount * Decimal(price)
+            coin = Coin.objects.only('id', 'name', 'price_usd', 'last_updated').get(
+                id=cryptocurrency_id, is_active=True)
+        except Coin.DoesNotExist:
+            return CURRENCY_NOT_SUPPORTED
 
-        user = get_object_or_404(User, user_id=user_id)
-        wallet = get_user_wallet(user_id)
-
-        # Get current balances
-        current_usd_balance = Decimal(str(wallet.balance.get('usd', 0)))
-        current_crypto_balance = Decimal(
-            str(wallet.balance.get(cryptocurrency_id, 0)))
+        # Use the stored price while it is fresh, otherwise go through the price cache/API
+        price = coin.price_usd
+        if not price or coin.last_updated is None or \
+                timezone.now() - coin.last_updated > timedelta(seconds=PRICE_CACHE_TTL):
+            price = get_coin_price(cryptocurrency_id)
+        if not price or not _price_units(price):
+            return PRICE_UNAVAILABLE
 
         # Simulate the transaction
-        with transaction.atomic():
-            if transaction_type == 'buy':
-                if current_usd_balance < usd_value:
-                    return TransactionResult(
-                        success=False,
-                        transaction_record=None,
-                        status='insufficient_funds',
-                        message=f" Need: {usd_value:.8f}(USD) to buy {amount}({coin.name}), Have: {current_usd_balance}(USD)",
-                        final_balances={
-                            'usd': current_usd_balance,
-                            cryptocurrency_id: current_crypto_balance
-                        },
-                        error_type='InsufficientFundsError'
-                    )
-                new_usd_balance = current_usd_balance - usd_value
-                new_crypto_balance = current_crypto_balance + amount
-
-                # Record the buy transaction
-                transaction_record = Transaction.objects.create(
-                    user=user,
-                    wallet=wallet,
-                    base_currency='usd',
-                    base_amount=usd_value,
-                    destination_currency=cryptocurrency_id,
-                    destination_amount=amount,
-                    rate=price,
-                    transaction_type='buy',
-                    status='completed',
-                    transaction_details=f"Bought {amount} {cryptocurrency_id} at {price} USD"
-                )
-            elif transaction_type == 'sell':
-                if current_crypto_balance < amount:
-                    return TransactionResult(
-                        success=False,
-                        transaction_record=None,
-                        status='insufficient_funds',
-                        message=f"Insufficient {cryptocurrency_id} balance. Need: {amount}{cryptocurrency_id}, Have: {current_crypto_balance}",
-                        final_balances={
-                            'usd': current_usd_balance,
-                            cryptocurrency_id: current_crypto_balance
-                        },
-                        error_type='InsufficientFundsError'
-                    )
-                new_usd_balance = current_usd_balance + usd_value
-                new_crypto_balance = current_crypto_balance - amount
-
-                # Record the sell transaction
-                transaction_record = Transaction.objects.create(
-                    user=user,
-                    wallet=wallet,
-                    base_currency=cryptocurrency_id,
-                    base_amount=amount,
-                    destination_currency='usd',
-                    destination_amount=usd_value,
-                    rate=price,
-                    transaction_type='sell',
-                    status='completed',
-                    transaction_details=f"Sold {amount} {cryptocurrency_id} at {price} USD"
-                )
-            else:
-                return TransactionResult(
-                    success=False,
-                    transaction_record=None,
-                    status='invalid_transaction_type',
-                    message="Transaction type must be 'buy' or 'sell'",
-                    error_type='ValidationError'
-                )
-
-            # update the wallet balances
-            wallet.balance['usd'] = str(new_usd_balance)
-            wallet.balance[cryptocurrency_id] = str(new_crypto_balance)
-            wallet.save()
-
-            # Return the transaction result
-            transaction_type = 'bought' if transaction_type == 'buy' else 'sold'
-            return TransactionResult(
-                success=True,
-                transaction_record=transaction_record,
-                status='completed',
-                message=f"Successfully {transaction_type} {amount} {cryptocurrency_id} at {price} USD",
-                final_balances={
-                    'usd': new_usd_balance,
-                    cryptocurrency_id: new_crypto_balance
-                }
-            )
-    except Exception as e:
-        # Log unexpected error here
-        print(f"Unexpected Error: {str(e)}")
+        return _DISPATCH[transaction_type](user_id, coin, units, price)
+    except _EXECUTION_ERRORS as e:
+        logger.exception(
+            "Unexpected error during %s for user %s", transaction_type, user_id)
         return TransactionResult(
             success=False,
             transaction_record=None,
@@ -365,61 +457,58 @@ def simulate_and_execute_buy_sell(
         )
 
 
+def _swap_in_thread(swap: Dict) -> TransactionResult:
+    try:
+        return simulate_and_execute_swap(**swap)
+    finally:
+        # Worker threads get their own DB connection, close it with the thread's work
+        connection.close()
+
+
+def execute_swaps_batch(swaps: Iterable[Dict], max_workers: int = 8) -> List[TransactionResult]:
+    """
+    Executes several users' swaps concurrently, overlapping their price lookups and DB round trips.
+    Each swap runs in its own thread, connection and transaction.
+
+    Args:
+        swaps: simulate_and_execute_swap keyword arguments, one dict per swap
+        max_workers: Maximum number of swaps in flight
+
+    Returns:
+        List of TransactionResult objects in the same order as swaps
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_swap_in_thread, swaps))
+
+
 def deposit_usd(user_id: str, amount: Union[Decimal, float, int]) -> TransactionResult:
     # validate input
     if not all([user_id, amount]):
-        return TransactionResult(
-            success=False,
-            transaction_record=None,
-            status='invalid_input',
-            message='All parameters are required',
-            error_type='ValidationError'
-        )
-    if not isinstance(amount, (Decimal, float, int)):
-        return TransactionResult(
-            success=False,
-            transaction_record=None,
-            status='invalid_input',
-            message='Amount must be a number',
-            error_type='ValidationError'
-        )
-    amount = Decimal(str(amount))
+        return ALL_PARAMS_REQUIRED
+    if not _is_finite_number(amount):
+        return AMOUNT_NOT_A_NUMBER
+    amount = to_decimal(amount)
     if amount <= 0:
-        return TransactionResult(
-            success=False,
-            transaction_record=None,
-            status='invalid_input',
-            message='Amount must be positive',
-            error_type='ValidationError'
-        )
-    # get user and wallet
+        return AMOUNT_NOT_POSITIVE
+    if not to_units(amount):
+        return AMOUNT_TOO_SMALL
     try:
-        wallet = get_user_wallet(user_id)
-        current_balance: dict = wallet.balance
-        current_balance['usd'] = Decimal(current_balance.get('usd', 0))
-        # current_usd_balance = Decimal(str(wallet.balance.get('usd', '0')))
-        # print(f"current usd balance: {current_usd_balance}")
-    except:
+        new_balance = credit_wallet(user_id, 'usd', amount)
+    except _EXECUTION_ERRORS:
+        logger.exception("Deposit failed for user %s", user_id)
         return TransactionResult(
             success=False,
             transaction_record=None,
-            status='not_found',
-            message=f'user with id:{user_id}, wallet not found',
+            status='failed_deposit',
+            message=f' Deposit of {amount} USD was unsuccessful',
             error_type='DoesNotExistError'
         )
-    # update the wallet
-    try:
-        current_balance['usd'] = str(current_balance['usd'] + amount)
-        wallet.balance = current_balance
-        wallet.save()
-        print(f'new usd balance: {wallet.balance["usd"]}')
-    except Exception as e:
-        print(f"Error: {e}")
+    if new_balance is None:
         return TransactionResult(
             success=False,
             transaction_record=None,
-            status='failed_deposit',
-            message=f' Deposit of {amount} USD was unsuccessful',
+            status='not_found',
+            message=f'user with id:{user_id}, wallet not found',
             error_type='DoesNotExistError'
         )
     # return status
@@ -429,6 +518,6 @@ def deposit_usd(user_id: str, amount: Union[Decimal, float, int]) -> Transaction
         status="deposit_successful",
         message=f" Successfully deposited {amount} USD",
         final_balances={
-            "USD": wallet.balance['usd']
+            "USD": new_balance
         }
     )
@@ -0,0 +1,13 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Coin
+from .cache import invalidate_active_coin_ids
+
+
+@receiver([post_save, post_delete], sender=Coin)
+def reset_active_coin_cache(sender, instance, **kwargs):
+    # Partial saves that leave is_active alone (price updates) can't change the set
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and 'is_active' not in update_fields:
+        return
+    invalidate_active_coin_ids()
@@ -1,109 +1,144 @@
-# from django.test import TestCase
-import requests
-import requests_cache
-from templates.URLS import Coingecko
+from datetime import timedelta
+from unittest import mock
+from django.db import DatabaseError
+from django.test import TestCase
+from django.utils import timezone
 from decimal import Decimal
-from wallet.models import User
-from wallet.utils import get_user_wallet, get_user_transactions
-from .models import Coin, Vs_currencies
-from .utils import get_swap_destination_amount
-from .services import simulate_and_execute_buy_sell, simulate_and_execute_swap, get_object_or_404, deposit_usd
-from django.db.models import Count
-
-requests_cache.install_cache('coingecko_cache', expire_after=3600)
-
-rand_id = '123456'
-test_user, _ = User.objects.get_or_create(
-    user_id=rand_id, username='test_user')
-if _:
-    print('New user created')
-else:
-    print('User Found')
-test_user_wallet = get_user_wallet(test_user.user_id)
-# test creating same user raise unique key constraint error
-if test_user_wallet:
-    print(f"user {test_user.username}: {test_user.user_id}, wallet found")
-
-# test fetch coins and vs
-currency_code = "eth"
-cryptocurrency_id = "ethereum"
-vs_currency = "usd"
-
-
-# test deposit = PASS
-# deposit_result = deposit_usd(test_user.user_id, 500000)
-# print(
-#     f"\ntransaction status: {deposit_result.status},{deposit_result.message}")
-#  test buy = PASS
-# buy_result = simulate_and_execute_buy_sell(
-#     test_user.user_id, "ethereum", 16, "buy")
-# print(f"\ntransaction status: {buy_result.status},{buy_result.message}")
-# # test sell = PASS
-# sell_result = simulate_and_execute_buy_sell(
-#     test_user.user_id, "ethereum", 49, "sell")
-# print(f"\ntransaction status: {sell_result.status},{sell_result.message}")
-
-# test swap
-# swap_result = simulate_and_execute_swap(
-#     test_user.user_id, cryptocurrency_id, "bitcoin", 300)
-# print(f"\ntransaction status: {swap_result.status},{swap_result.message}")
-# print(f"new balance: {test_user_wallet.balance}")
-
-# get user transactions - PASS
-# test_user_transactions = get_user_transactions(
-#     test_user.user_id, currency="usd")
-# for transaction in test_user_transactions:
-#     rate = transaction.rate
-#     print(rate)
-# print(test_user_transactions)
-
-# get swap destination
-amoount = 1
-destination_amount = get_swap_destination_amount(
-    'bitcoin', 'ethereum', amoount)
-print(f'swap {amoount} bitcoin for [{destination_amount}] ethereum')
-# =====================================
-# print(fetch_supported_VScurrencies())
-# coins = fetch_supported_cryptocurrencies()
-# vs_currencies = fetch_supported_VScurrencies()
-
-# print(vs_currencies in coins)
-# usd = next(
-#    (currency for currency in vs_currencies if currency.lower() == "usd"), None)
-# print(vs_currencies)
-'''bitcoin = next(
-    (coin for coin in coins if coin['name'].lower() == "bitcoin"), None)
-ethereum = next(
-    (coin for coin in coins if coin['name'].lower() == "ethereum"), None)
-print(bitcoin) #{'id': 'bitcoin', 'symbol': 'btc', 'name': 'Bitcoin'}
-print(ethereum)'''
-# print(fetch_exchange_rate("bitcoin", "usd")
-#       )  # {'bitcoin': {'usd': 104254, 'eur': 100146}}
-# time.sleep(3)
-# print(Coingecko.COIN_PRICE)
-# coin_price = requests.get(f"{Coingecko.COIN_PRICE}", params={'ids': 'ethereum', 'vs_currencies': 'usd'}
-#                           ).json()
-# print(coin_price)
-# print("fetch currency, fetch price, sort categories".upper())
-#
-# coins_response = requests.get(f"{Coingecko.API_BASE}/coins/list")
-# coins = coins_response.json()
-# print(len(coins))
-# # Fetch the prices of all coins in one request
-# coin_ids = ','.join([coin['id'] for coin in coins])
-# # print(coin_ids)
-# # coin_prices_response = requests.get(
-# #     f"{Coingecko.API_BASE}/simple/price",
-# #     params={'ids': coin_ids, 'vs_currencies': 'usd'}
-# # )
-# # coin_prices_response.raise_for_status()
-# # coin_prices = coin_prices_response.json()
-# # print(coin_prices)
-# coin_id = "bitcoin"
-# quote_currency = "usd"
-# params = {'ids': f"{coin_id}", 'vs_currencies': f"{quote_currency}"}
-# response = requests.get(Coingecko.COIN_PRICE, params=params)
-# response.raise_for_status()  # Raise an exception for HTTP errors
-# data = response.json()
-# price = Decimal(data[coin_id][quote_currency])
-# print(price)
+from wallet.models import User, WalletBalance
+from wallet.utils import get_user_wallet
+from .cache import active_coin_ids, invalidate_active_coin_ids
+from .models import Coin
+from .services import (AMOUNT_NOT_A_NUMBER, AMOUNT_TOO_SMALL, CURRENCY_NOT_SUPPORTED,
+                       INVALID_TRANSACTION_TYPE, SWAP_PRICE_UNAVAILABLE,
+                       simulate_and_execute_buy_sell,
+                       simulate_and_execute_swap, simulate_many_swaps, deposit_usd)
+
+
+PRICES = {'bitcoin': Decimal('50000'), 'ethereum': Decimal('3000')}
+
+
+class TradeUnitsTests(TestCase):
+    '''Both legs of a trade move as whole units, and the record matches what moved'''
+
+    def setUp(self):
+        for coin_id, price in PRICES.items():
+            Coin.objects.create(id=coin_id, name=coin_id.title(), symbol=coin_id[:3],
+                                price_usd=price, last_updated=timezone.now())
+        invalidate_active_coin_ids()
+        user = User.objects.create(user_id='1', username='user')
+        self.wallet = get_user_wallet(user.user_id)
+        deposit_usd('1', 100)
+        patcher = mock.patch('exchange.services.get_coin_prices',
+                             lambda ids: {i: PRICES[i] for i in ids})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def units(self):
+        return dict(WalletBalance.objects.filter(wallet=self.wallet)
+                    .values_list('currency', 'amount_units'))
+
+    def test_dust_buy_is_rejected(self):
+        result = simulate_and_execute_buy_sell('1', 'bitcoin', Decimal('1e-12'), 'buy')
+        self.assertIs(result, AMOUNT_TOO_SMALL)
+        self.assertEqual(self.units(), {'usd': 100 * 10 ** 8})
+
+    def test_buy_records_moved_units(self):
+        result = simulate_and_execute_buy_sell('1', 'bitcoin', Decimal('0.000000019'), 'buy')
+        record = result.transaction_record
+        # 1 unit of bitcoin at 50000 USD costs exactly 0.0005 USD
+        self.assertEqual(self.units(), {'usd': 100 * 10 ** 8 - 50000, 'bitcoin': 1})
+        self.assertEqual(record.base_amount, Decimal('0.0005'))
+        self.assertEqual(record.destination_amount, Decimal('0.00000001'))
+
+    def test_buy_cost_rounds_up_once(self):
+        simulate_and_execute_buy_sell('1', 'ethereum', Decimal('0.00000001'), 'buy')
+        # 0.00000001 ETH at 3000 USD is 0.00003 USD, exactly 3000 units
+        self.assertEqual(self.units()['usd'], 100 * 10 ** 8 - 3000)
+
+    def test_swap_records_moved_units(self):
+        simulate_and_execute_buy_sell('1', 'bitcoin', Decimal('0.001'), 'buy')
+        result = simulate_and_execute_swap('1', 'bitcoin', 'ethereum', Decimal('0.000100009'))
+        record = result.transaction_record
+        self.assertEqual(record.base_amount, Decimal('0.0001'))
+        self.assertEqual(record.destination_amount, Decimal('0.00166666'))
+        self.assertEqual(self.units()['bitcoin'], 90000)
+        self.assertEqual(self.units()['ethereum'], 166666)
+
+    def test_dust_swap_is_rejected(self):
+        simulate_and_execute_buy_sell('1', 'ethereum', Decimal('0.001'), 'buy')
+        before = self.units()
+        result = simulate_and_execute_swap('1', 'ethereum', 'bitcoin', Decimal('0.00000001'))
+        self.assertIs(result, AMOUNT_TOO_SMALL)
+        self.assertEqual(self.units(), before)
+
+    def test_stale_stored_price_is_refreshed(self):
+        Coin.objects.filter(id='bitcoin').update(
+            last_updated=timezone.now() - timedelta(hours=1))
+        with mock.patch('exchange.services.get_coin_price',
+                        return_value=Decimal('60000')) as get_coin_price:
+            result = simulate_and_execute_buy_sell('1', 'bitcoin', Decimal('0.001'), 'buy')
+        get_coin_price.assert_called_once_with('bitcoin')
+        self.assertEqual(result.transaction_record.base_amount, Decimal('60'))
+
+    def test_fresh_stored_price_is_used(self):
+        with mock.patch('exchange.services.get_coin_price') as get_coin_price:
+            result = simulate_and_execute_buy_sell('1', 'bitcoin', Decimal('0.001'), 'buy')
+        get_coin_price.assert_not_called()
+        self.assertEqual(result.transaction_record.base_amount, Decimal('50'))
+
+    def test_unrepresentable_price_is_unavailable(self):
+        simulate_and_execute_buy_sell('1', 'bitcoin', Decimal('0.001'), 'buy')
+        with mock.patch.dict(PRICES, {'ethereum': Decimal('1e-19')}):
+            result = simulate_and_execute_swap('1', 'bitcoin', 'ethereum', Decimal('0.0001'))
+        self.assertIs(result, SWAP_PRICE_UNAVAILABLE)
+        with self.assertRaises(ValueError):
+            simulate_many_swaps([(Decimal('1'), PRICES['bitcoin'], Decimal('1e-19'))])
+
+    def test_simulated_swap_matches_executed_swap(self):
+        self.assertEqual(
+            simulate_many_swaps([(Decimal('0.000100009'), PRICES['bitcoin'], PRICES['ethereum'])]),
+            [(Decimal('0.00166666'), Decimal('16.66666666'))])
+
+
+class ValidationTests(TestCase):
+    '''Bad input becomes a result, it never raises into the bot handlers'''
+
+    def test_signaling_nan_amount(self):
+        self.assertIs(simulate_and_execute_swap('1', 'bitcoin', 'ethereum', Decimal('sNaN')),
+                      AMOUNT_NOT_A_NUMBER)
+        self.assertIs(simulate_and_execute_buy_sell('1', 'bitcoin', Decimal('sNaN'), 'buy'),
+                      AMOUNT_NOT_A_NUMBER)
+
+    def test_non_string_codes(self):
+        self.assertIs(simulate_and_execute_buy_sell('1', 'bitcoin', 1, ['buy']),
+                      INVALID_TRANSACTION_TYPE)
+        self.assertIs(simulate_and_execute_buy_sell('1', 42, 1, 'buy'), CURRENCY_NOT_SUPPORTED)
+        self.assertIs(simulate_and_execute_swap('1', ['bitcoin'], 'ethereum', 1),
+                      CURRENCY_NOT_SUPPORTED)
+
+    def test_database_error_is_a_result(self):
+        with mock.patch('exchange.services.active_coin_ids', side_effect=DatabaseError('down')):
+            swap = simulate_and_execute_swap('1', 'bitcoin', 'ethereum', 1)
+            trade = simulate_and_execute_buy_sell('1', 'bitcoin', 1, 'buy')
+        self.assertEqual((swap.status, swap.error_type), ('error', 'DatabaseError'))
+        self.assertEqual((trade.status, trade.error_type), ('error', 'DatabaseError'))
+
+
+class ActiveCoinCacheTests(TestCase):
+    def setUp(self):
+        self.coin = Coin.objects.create(id='bitcoin', name='Bitcoin', symbol='btc')
+        invalidate_active_coin_ids()
+        active_coin_ids()
+
+    def test_price_save_keeps_cache(self):
+        with mock.patch('exchange.cache.Coin.objects') as objects:
+            self.coin.price_usd = Decimal('50000')
+            self.coin.save(update_fields=['price_usd', 'last_updated'])
+            self.assertEqual(active_coin_ids(), frozenset({'bitcoin'}))
+        objects.filter.assert_not_called()
+
+    def test_deactivation_resets_cache(self):
+        self.coin.is_active = False
+        self.coin.save(update_fields=['is_active'])
+        self.assertEqual(active_coin_ids(), frozenset())
+
@@ -1,15 +1,186 @@
+import logging
+import sys
+import threading
+import time
 import requests
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from decimal import Decimal
-from typing import Union, Optional
+from typing import Dict, Iterable, Tuple, Union, Optional
+from wallet.utils import InsufficientFundsError  # noqa: F401
 from .models import Coin, Vs_currencies
-from django.shortcuts import get_object_or_404
+from django.utils import timezone
 
 from templates.URLS import Coingecko
 
+logger = logging.getLogger(__name__)
+
+# Longest Retry-After wait (seconds) a request sleeps through, the read timeout doesn't cover it
+MAX_RETRY_AFTER = 1
+
+
+class CappedRetry(Retry):
+    '''Retry that honours Retry-After, but never waits longer than MAX_RETRY_AFTER'''
+
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+
+# Shared keep-alive session for CoinGecko, reuses pooled connections across calls.
+# Rate limits and gateway errors are retried with backoff, honouring a capped Retry-After;
+# longer rate limiting fails the request and counts towards the circuit breaker.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=20, pool_maxsize=50,
+    max_retries=CappedRetry(total=3, backoff_factor=0.2,
+                            status_forcelist=[429, 502, 503, 504])))
+# (connect, read) timeouts in seconds for every CoinGecko request
+REQUEST_TIMEOUT = (1, 3)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    '''Raised instead of calling CoinGecko while the circuit breaker is open'''
+
+
+class CircuitBreaker:
+    '''
+    Stops calling a failing service for reset_timeout seconds after fail_max consecutive
+    failures, then lets one trial call through to decide whether to close again.
+    '''
+
+    def __init__(self, fail_max: int = 5, reset_timeout: float = 30):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        with self._lock:
+            if self._opened_at is not None:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError("CoinGecko circuit is open")
+                # Half-open: the next failure reopens the circuit right away
+                self._opened_at = None
+                self._failures = self.fail_max - 1
+        try:
+            result = func(*args, **kwargs)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self._failures += 1
+                if self._failures >= self.fail_max:
+                    self._opened_at = time.time()
+            raise
+        with self._lock:
+            self._failures = 0
+        return result
+
+
+COINGECKO_BREAKER = CircuitBreaker(fail_max=5, reset_timeout=30)
 
-class InsufficientFundsError(Exception):
-    pass
+
+def _get(url: str, **kwargs) -> requests.Response:
+    response = SESSION.get(url, timeout=REQUEST_TIMEOUT, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def coingecko_get(url: str, breaker: CircuitBreaker = COINGECKO_BREAKER,
+                  **kwargs) -> requests.Response:
+    '''
+    GETs a CoinGecko url through the shared session and a circuit breaker, the live one by
+    default; background jobs pass their own so their failures don't trip it for live trades.
+    Raises a RequestException (CircuitOpenError while the circuit is open) on failure
+    '''
+    return breaker.call(_get, url, **kwargs)
+
+
+# Recently fetched prices, {(currency_id, vs_currency): (fetched_at, price)}
+_PRICE_CACHE: Dict[Tuple[str, str], Tuple[float, Decimal]] = {}
+PRICE_CACHE_TTL = 30
+PRICE_CACHE_MAXSIZE = 1024
+# Prices are also shared between processes through the Django cache (Redis when configured)
+SHARED_PRICE_TTL = 20
+# Minimum age of a stored price_usd before it is overwritten
+PRICE_SAVE_INTERVAL = timedelta(seconds=60)
+
+
+def _shared_price_key(currency_id: str, vs_currency: str) -> str:
+    return f"price:{currency_id}/{vs_currency}"
+
+
+def _get_cached_prices(currency_ids: Iterable[str], vs_currency: str) -> Dict[str, Decimal]:
+    '''Returns the cached prices of currency_ids, checking this process first and the shared cache second'''
+    prices, missing = {}, []
+    now = time.time()
+    for currency_id in currency_ids:
+        entry = _PRICE_CACHE.get((currency_id, vs_currency))
+        if entry and now - entry[0] < PRICE_CACHE_TTL:
+            prices[currency_id] = entry[1]
+        else:
+            missing.append(currency_id)
+    if missing:
+        try:
+            shared = cache.get_many(
+                [_shared_price_key(currency_id, vs_currency) for currency_id in missing])
+        except Exception as e:
+            logger.warning("Shared price cache unavailable: %s", e)
+            return prices
+        for currency_id in missing:
+            value = shared.get(_shared_price_key(currency_id, vs_currency))
+            if value is not None:
+                prices[currency_id] = Decimal(value)
+                _cache_local_price(currency_id, vs_currency, prices[currency_id])
+    return prices
+
+
+def _cache_local_price(currency_id: str, vs_currency: str, price: Decimal):
+    if len(_PRICE_CACHE) >= PRICE_CACHE_MAXSIZE:
+        _PRICE_CACHE.clear()
+    _PRICE_CACHE[(currency_id, vs_currency)] = (time.time(), price)
+
+
+def _cache_prices(prices: Dict[str, Decimal], vs_currency: str):
+    '''Caches freshly fetched prices in this process and, as strings to keep precision, in the shared cache'''
+    for currency_id, price in prices.items():
+        _cache_local_price(currency_id, vs_currency, price)
+    try:
+        cache.set_many({_shared_price_key(currency_id, vs_currency): str(price)
+                        for currency_id, price in prices.items()}, timeout=SHARED_PRICE_TTL)
+    except Exception as e:
+        logger.warning("Shared price cache unavailable: %s", e)
+
+
+def _should_store_price(coin: Coin, price: Decimal) -> bool:
+    '''Persist a first price right away, later changes at most once per PRICE_SAVE_INTERVAL'''
+    if coin.price_usd is None:
+        return True
+    return coin.price_usd != price and (
+        coin.last_updated is None or timezone.now() - coin.last_updated > PRICE_SAVE_INTERVAL)
+
+
+# Lowercased, interned currency codes, {raw code: normalized code}
+_NORMALIZED: Dict[str, str] = {}
+NORMALIZED_MAXSIZE = 4096
+
+
+def normalize_code(code: str) -> str:
+    '''Lowercases a currency code, repeated codes are a dict lookup instead of a new string'''
+    normalized = _NORMALIZED.get(code)
+    if normalized is None:
+        if len(_NORMALIZED) >= NORMALIZED_MAXSIZE:
+            _NORMALIZED.clear()
+        normalized = _NORMALIZED[code] = sys.intern(code.lower())
+    return normalized
+
+
+def to_decimal(value: Union[Decimal, float, int, str]) -> Decimal:
+    '''Converts a number to Decimal once, values that already are Decimals are passed through'''
+    return value if isinstance(value, Decimal) else Decimal(str(value))
 
 
 class UnexpectedError(Exception):
@@ -25,45 +196,106 @@ def get_coin_price(currency_id: str, vs_currency: str = 'usd') -> Optional[Decim
     try:
         url = Coingecko.COIN_PRICE
 
+        currency_id = normalize_code(currency_id)
+        vs_currency = normalize_code(vs_currency)
+        cached_price = _get_cached_prices([currency_id], vs_currency).get(currency_id)
+        if cached_price is not None:
+            return cached_price
+
         # Validate currency codes
-        currency_id = currency_id.lower()
-        vs_currency = vs_currency.lower()
         try:
-            coin = get_object_or_404(Coin, id=currency_id)
-            quote = get_object_or_404(Vs_currencies, currency=vs_currency)
-        except:
+            coin = Coin.objects.only('id', 'price_usd', 'last_updated').get(id=currency_id)
+        except Coin.DoesNotExist:
+            raise ValueError(
+                f"Unsupported currency(ies): {currency_id}/{vs_currency}")
+        if not Vs_currencies.objects.filter(currency=vs_currency).exists():
             raise ValueError(
                 f"Unsupported currency(ies): {currency_id}/{vs_currency}")
 
         # Fetch price data
         try:
-            coin_id = coin.id
-            quote_currency = quote.currency
+            coin_id = currency_id
+            quote_currency = vs_currency
 
             params = {'ids': f"{coin_id}",
                       'vs_currencies': f"{quote_currency}"}
-            response = requests.get(url, params=params)
-            response.raise_for_status()  # Raise an exception for HTTP errors
-            data = response.json()
-            price = Decimal(data[coin_id][quote_currency])
+            response = coingecko_get(url, params=params)
+            data = response.json(parse_float=Decimal)
+            price = to_decimal(data[coin_id][quote_currency])
+            _cache_prices({coin_id: price}, quote_currency)
 
-            coin.price_usd = price
-            coin.save()
+            if quote_currency == 'usd' and _should_store_price(coin, price):
+                coin.price_usd = price
+                coin.save(update_fields=['price_usd', 'last_updated'])
             return price
 
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")
-        except requests.exceptions.ConnectionError as conn_err:
-            print(f"Connection error occurred: {conn_err}")
-        except requests.exceptions.Timeout as timeout_err:
-            print(f"Timeout error occurred: {timeout_err}")
         except requests.exceptions.RequestException as req_err:
-            print(f"An error occurred: {req_err}")
+            logger.warning("Price request failed for %s/%s: %s", currency_id, vs_currency, req_err)
         if coin.price_usd:
             return coin.price_usd
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+    except ValueError as e:
+        logger.warning("%s", e)
         return None
+    except Exception:
+        logger.exception("Price lookup failed for %s/%s", currency_id, vs_currency)
+        return None
+
+
+def get_coin_prices(currency_ids: Iterable[str], vs_currency: str = 'usd') -> Dict[str, Decimal]:
+    '''
+    Fetches the current prices of several cryptocurrencies with a single CoinGecko request.
+    Falls back to the last stored price of a coin if the request fails.
+    Returns {currency_id: price}, coins without any known price are left out
+    '''
+    try:
+        currency_ids = [normalize_code(currency_id) for currency_id in currency_ids]
+        vs_currency = normalize_code(vs_currency)
+
+        prices = _get_cached_prices(currency_ids, vs_currency)
+        if len(prices) == len(currency_ids):
+            return prices
+
+        coins = {coin.id: coin for coin in Coin.objects.filter(
+            id__in=[currency_id for currency_id in currency_ids if currency_id not in prices])}
+        if not coins or not Vs_currencies.objects.filter(currency=vs_currency).exists():
+            raise ValueError(
+                f"Unsupported currency(ies): {currency_ids}/{vs_currency}")
+
+        try:
+            params = {'ids': ','.join(coins), 'vs_currencies': vs_currency}
+            response = coingecko_get(Coingecko.COIN_PRICE, params=params)
+            data = response.json(parse_float=Decimal)
+            fetched, changed = {}, []
+            for coin_id, coin in coins.items():
+                if data.get(coin_id, {}).get(vs_currency) is None:
+                    continue
+                price = fetched[coin_id] = to_decimal(data[coin_id][vs_currency])
+                if vs_currency == 'usd' and _should_store_price(coin, price):
+                    coin.price_usd = price
+                    coin.last_updated = timezone.now()
+                    changed.append(coin)
+            prices.update(fetched)
+            _cache_prices(fetched, vs_currency)
+            if changed:
+                Coin.objects.bulk_update(changed, ['price_usd', 'last_updated'])
+        except requests.exceptions.RequestException as req_err:
+            logger.warning("Price request failed for %s/%s: %s", currency_ids, vs_currency, req_err)
+
+        for coin_id, coin in coins.items():
+            if coin_id not in prices and coin.price_usd:
+                prices[coin_id] = coin.price_usd
+        return prices
+    except ValueError as e:
+        logger.warning("%s", e)
+        return {}
+    except Exception:
+        logger.exception("Price lookup failed for %s/%s", currency_ids, vs_currency)
+        return {}
+
+
+def _swap_math(origin_amount: float, origin_usd_price: float, destination_usd_price: float) -> float:
+    '''Destination amount for a swap quote, in float64'''
+    return origin_amount * origin_usd_price / destination_usd_price
 
 
 def get_swap_destination_amount(
@@ -72,34 +304,30 @@ def get_swap_destination_amount(
 ) -> Union[Decimal, float, None]:
     '''
     Calculates the amount of a destination currency that can be obtained from a given amount of an origin currency.
-    Returns The amount of the destination currency that can be obtained, or None
+    Returns The (float) amount of the destination currency that can be obtained, or None.
+    The quote is not rounded, an executed swap can deliver up to 0.00000001 less.
     '''
     try:
-        origin_amount = Decimal(str(origin_amount))
-        origin_currency_id = origin_currency_id.lower()
-        destination_currency_id = destination_currency_id.lower()
-
-        # Validate currency codes
-        try:
-            coin = get_object_or_404(Coin, id=origin_currency_id)
-            quote = get_object_or_404(Coin, id=destination_currency_id)
-        except:
-            raise ValueError(
-                f"Either currencies are unsupported: {origin_currency_id}, {destination_currency_id}")
+        origin_amount = float(origin_amount)
+        origin_currency_id = normalize_code(origin_currency_id)
+        destination_currency_id = normalize_code(destination_currency_id)
 
-        # Get price rates
-        origin_usd_price = get_coin_price(origin_currency_id)
-        destination_usd_price = get_coin_price(destination_currency_id)
+        # Get both price rates with one batched request, unknown currencies get no entry
+        prices = get_coin_prices([origin_currency_id, destination_currency_id])
+        origin_usd_price = prices.get(origin_currency_id)
+        destination_usd_price = prices.get(destination_currency_id)
 
         # Validate price data
         if not (origin_usd_price and destination_usd_price):
             raise ValidationError(
-                "Price data unavailable for one or both currencies")
+                f"Price data unavailable for {origin_currency_id} or {destination_currency_id}")
 
-        # Calculate swap amounts
-        total_swap_value = origin_amount * origin_usd_price
-        destination_amount = total_swap_value / destination_usd_price
-        return destination_amount
-    except Exception as e:
-        print(f"Error: {e}")
+        # Indicative quote in float. Executed swaps move whole 10^-8 units rounded down
+        # (exchange.services._swap_units), so they can deliver slightly less than this
+        return _swap_math(origin_amount, float(origin_usd_price), float(destination_usd_price))
+    except (ValueError, ValidationError) as e:
+        logger.warning("%s", e)
+        return None
+    except Exception:
+        logger.exception("Swap quote failed for %s -> %s", origin_currency_id, destination_currency_id)
         return None
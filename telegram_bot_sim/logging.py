@@ -0,0 +1,29 @@
+"""
+Non-blocking logging for telegram_bot_sim.
+
+Records are pushed onto a queue by the calling thread and written to stderr
+by a background QueueListener, so request handlers never wait on I/O.
+"""
+
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+def queue_handler(level=logging.NOTSET):
+    """Build a QueueHandler whose records are emitted by a background listener"""
+    log_queue = queue.Queue(-1)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    listener = QueueListener(log_queue, stream_handler,
+                             respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    handler = QueueHandler(log_queue)
+    handler.setLevel(level)
+    return handler
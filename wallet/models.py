@@ -1,5 +1,6 @@
 from django.db import models
 from django.core.validators import MinValueValidator
+from decimal import Decimal
 
 
 class User(models.Model):
@@ -9,8 +10,36 @@ class User(models.Model):
 
 class Wallet(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    # Stores balances in different currencies
-    balance = models.JSONField(default=dict)
+    # Balances in different currencies live in WalletBalance rows (wallet.balances)
+
+
+class WalletBalance(models.Model):
+    """One currency balance of a wallet, adjusted in place with F() updates"""
+    # Balances are whole multiples of 10**-BALANCE_PLACES, kept as integers
+    BALANCE_PLACES = 8
+
+    wallet = models.ForeignKey(
+        Wallet, on_delete=models.CASCADE, related_name='balances')
+    currency = models.CharField(max_length=50, db_index=True)
+    amount_units = models.BigIntegerField(
+        default=0,
+        help_text="Balance held in this currency, in 10^-8 units"
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['wallet', 'currency'], name='unique_wallet_currency'),
+            models.CheckConstraint(
+                condition=models.Q(amount_units__gte=0), name='wallet_balance_non_negative'),
+        ]
+
+    @property
+    def amount(self) -> Decimal:
+        return Decimal(self.amount_units).scaleb(-self.BALANCE_PLACES)
+
+    def __str__(self):
+        return f"{self.amount} {self.currency}"
 
 
 class Transaction(models.Model):
@@ -83,7 +112,14 @@ class Transaction(models.Model):
     # Indexes and ordering
     class Meta:
         indexes = [
-            models.Index(fields=['user', 'timestamp']),
+            # Newest first history and keyset pagination on (timestamp, id)
+            models.Index(fields=['user', '-timestamp', '-id'], name='tx_user_ts_id'),
+            # History filtered by type, in the same (-timestamp, -id) order as the unfiltered one
+            models.Index(fields=['user', 'transaction_type', '-timestamp', '-id'],
+                         name='tx_user_type_ts'),
+            # One per side of the currency filter, PostgreSQL ORs them with a bitmap scan
+            models.Index(fields=['user', 'base_currency', '-timestamp'], name='tx_user_base_ts'),
+            models.Index(fields=['user', 'destination_currency', '-timestamp'], name='tx_user_dest_ts'),
             models.Index(fields=['user', 'status']),
             models.Index(fields=['base_currency', 'destination_currency'])
         ]
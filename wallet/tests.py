@@ -1,3 +1,47 @@
+from decimal import ROUND_CEILING, Decimal
 from django.test import TestCase
+from .models import User, Wallet, WalletBalance
+from .utils import credit_balance, debit_balance, from_units, get_balances, to_units
 
-# Create your tests here.
+
+class UnitsTests(TestCase):
+    def test_to_units_truncates_below_one_unit(self):
+        self.assertEqual(to_units(Decimal('1.23456789')), 123456789)
+        self.assertEqual(to_units(Decimal('0.000000019')), 1)
+        self.assertEqual(to_units(Decimal('1e-12')), 0)
+
+    def test_to_units_rounding_can_be_chosen(self):
+        self.assertEqual(to_units(Decimal('0.000000011'), ROUND_CEILING), 2)
+
+    def test_round_trip(self):
+        self.assertEqual(from_units(123456789), Decimal('1.23456789'))
+        self.assertEqual(to_units(from_units(987654321)), 987654321)
+
+
+class BalanceTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(user_id='1', username='user')
+        self.wallet, _ = Wallet.objects.get_or_create(user=user)
+
+    def units(self, currency):
+        return WalletBalance.objects.get(wallet=self.wallet, currency=currency).amount_units
+
+    def test_credit_creates_then_adds(self):
+        credit_balance(self.wallet.id, 'usd', 150)
+        credit_balance(self.wallet.id, 'usd', 50)
+        self.assertEqual(self.units('usd'), 200)
+        self.assertEqual(get_balances(self.wallet.id), {'usd': from_units(200)})
+
+    def test_debit_covered_amount(self):
+        credit_balance(self.wallet.id, 'usd', 100)
+        self.assertTrue(debit_balance(self.wallet.id, 'usd', 100))
+        self.assertEqual(self.units('usd'), 0)
+
+    def test_debit_insufficient_leaves_balance(self):
+        credit_balance(self.wallet.id, 'usd', 100)
+        self.assertFalse(debit_balance(self.wallet.id, 'usd', 101))
+        self.assertEqual(self.units('usd'), 100)
+
+    def test_debit_without_balance_row(self):
+        self.assertFalse(debit_balance(self.wallet.id, 'btc', 1))
+        self.assertFalse(WalletBalance.objects.filter(currency='btc').exists())
@@ -1,48 +1,165 @@
-from .models import Wallet, User
+from .models import Transaction, Wallet, WalletBalance, User
+from datetime import datetime
 from django.shortcuts import get_object_or_404
-from django.db import models
-from django.db.models import QuerySet
-from typing import Optional
+from django.db import connection, models, transaction
+from django.db.models import F, QuerySet
+from functools import lru_cache
+from decimal import ROUND_FLOOR, Decimal
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
+import warnings
+
+__all__ = [
+    'InsufficientFundsError', 'TRANSACTION_CHUNK_SIZE',
+    'get_user_wallet', 'to_units', 'from_units',
+    'debit_balance', 'credit_balance', 'get_balances',
+    'get_wallet_balances', 'credit_wallet', 'get_user_transactions',
+]
+
+# Rows fetched per round trip when streaming transactions
+TRANSACTION_CHUNK_SIZE = 500
 
 
 class InsufficientFundsError(Exception):
     pass
 
 
-def get_user_wallet(telegram_user_id: str) -> Wallet:
+def get_user_wallet(telegram_user_id: str) -> Optional[Wallet]:
     """
     Gets or creates a wallet for a given Telegram user ID.
-    First ensures user exists, then gets or creates their wallet.
+    The common case, an existing wallet, is a single joined query; only a
+    missing wallet falls back to looking up the user and creating one.
 
     Args:
         telegram_user_id (str): Telegram user ID
 
     Returns:
-        Wallet: The user's wallet instance
-
-    Raises:
-        Http404: If user doesn't exist
+        Wallet: The user's wallet instance, or None if the user doesn't exist
     """
-    # (404 if not found)
+    wallet = Wallet.objects.filter(user__user_id=telegram_user_id).first()
+    if wallet is not None:
+        return wallet
+
     try:
-        user = get_object_or_404(User, user_id=telegram_user_id)
+        user = User.objects.get(user_id=telegram_user_id)
+    except User.DoesNotExist:
+        return None
 
-        # Get or create their wallet (a fallback if create wallet signal failed)
-        wallet, created = Wallet.objects.get_or_create(
-            user=user,
-            defaults={'balance': {}}  # set empty balance if created
-        )
-        return wallet
-    except:
+    # Get or create their wallet (a fallback if create wallet signal failed)
+    wallet, created = Wallet.objects.get_or_create(user=user)
+    return wallet
+
+
+def to_units(amount: Decimal, rounding: str = ROUND_FLOOR) -> int:
+    """Converts an amount to whole balance units, dropping digits beyond BALANCE_PLACES"""
+    return int(amount.scaleb(WalletBalance.BALANCE_PLACES).to_integral_value(rounding))
+
+
+def from_units(units: int) -> Decimal:
+    return Decimal(units).scaleb(-WalletBalance.BALANCE_PLACES)
+
+
+def debit_balance(wallet_id: int, currency: str, units: int) -> bool:
+    """
+    Subtracts whole units from one currency balance, but only if it covers them.
+    The check and the debit are a single conditional UPDATE, so no row lock is needed.
+
+    Args:
+        wallet_id: Wallet primary key
+        currency: Balance currency, e.g. 'usd'
+        units: Units (10^-BALANCE_PLACES) to subtract, see to_units
+
+    Returns:
+        bool: True if the balance was debited, False if funds were insufficient
+    """
+    return WalletBalance.objects.filter(
+        wallet_id=wallet_id, currency=currency, amount_units__gte=units
+    ).update(amount_units=F('amount_units') - units) == 1
+
+
+def credit_balance(wallet_id: int, currency: str, units: int) -> None:
+    """
+    Adds whole units to one currency balance, creating the balance row if needed.
+    On PostgreSQL and SQLite this is a single INSERT ... ON CONFLICT DO UPDATE.
+
+    Args:
+        wallet_id: Wallet primary key
+        currency: Balance currency, e.g. 'usd'
+        units: Units (10^-BALANCE_PLACES) to add, see to_units
+    """
+    if connection.vendor in ('postgresql', 'sqlite'):
+        table = connection.ops.quote_name(WalletBalance._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (wallet_id, currency, amount_units) VALUES (%s, %s, %s) "
+                "ON CONFLICT (wallet_id, currency) "
+                f"DO UPDATE SET amount_units = {table}.amount_units + excluded.amount_units",
+                [wallet_id, currency, units]
+            )
+        return
+
+    balances = WalletBalance.objects.filter(wallet_id=wallet_id, currency=currency)
+    if not balances.update(amount_units=F('amount_units') + units):
+        _, created = WalletBalance.objects.get_or_create(
+            wallet_id=wallet_id, currency=currency, defaults={'amount_units': units})
+        if not created:  # Created concurrently since the update
+            balances.update(amount_units=F('amount_units') + units)
+
+
+def get_balances(wallet_id: int, currencies: Optional[Iterable[str]] = None) -> Dict[str, Decimal]:
+    """
+    Gets the balances of a wallet, optionally only some currencies.
+
+    Returns:
+        Dict[str, Decimal]: {currency: amount}, currencies without a balance row are left out
+    """
+    balances = WalletBalance.objects.filter(wallet_id=wallet_id)
+    if currencies is not None:
+        balances = balances.filter(currency__in=list(currencies))
+    return {currency: from_units(units)
+            for currency, units in balances.values_list('currency', 'amount_units')}
+
+
+def get_wallet_balances(telegram_user_id: str) -> Dict[str, Decimal]:
+    """Gets all balances of a Telegram user's wallet with a single query"""
+    return {currency: from_units(units) for currency, units in WalletBalance.objects.filter(
+        wallet__user__user_id=telegram_user_id).values_list('currency', 'amount_units')}
+
+
+def credit_wallet(telegram_user_id: str, currency: str, amount: Decimal) -> Optional[Decimal]:
+    """
+    Adds an amount to one currency balance of a user's wallet.
+
+    Args:
+        telegram_user_id: Telegram user ID
+        currency: Balance currency to credit, e.g. 'usd'
+        amount: Amount to add
+
+    Returns:
+        Decimal: The new balance, or None if the user has no wallet
+    """
+    wallet_id = Wallet.objects.filter(
+        user__user_id=telegram_user_id).values_list('id', flat=True).first()
+    if wallet_id is None:
         return None
+    with transaction.atomic():
+        credit_balance(wallet_id, currency, to_units(amount))
+        return get_balances(wallet_id, [currency])[currency]
+
+
+@lru_cache(maxsize=64)
+def _currency_q(currency: str) -> models.Q:
+    """Matches a currency on either side of a transaction, Q trees are never mutated so they are shared"""
+    return models.Q(base_currency=currency) | models.Q(destination_currency=currency)
 
 
 def get_user_transactions(telegram_user_id: str,
                           transaction_type: Optional[str] = None,
                           currency: Optional[str] = None,
                           limit: Optional[int] = None,
-                          offset: Optional[int] = None
-                          ) -> QuerySet:
+                          offset: Optional[int] = None,
+                          cursor: Optional[Tuple[datetime, int]] = None,
+                          as_iterator: bool = False
+                          ) -> Union[QuerySet, Iterator[Transaction]]:
     """
     Gets filtered transactions for a given Telegram user ID.
 
@@ -51,34 +168,48 @@ def get_user_transactions(telegram_user_id: str,
         transaction_type: Optional filter by type ('buy', 'sell', 'swap')
         currency: Optional filter by currency (base_currency or to_currency for swaps)
         limit: Optional limit number of results
-        offset: Optional offset for pagination
+        offset: Deprecated, use cursor; OFFSET scans every skipped row
+        cursor: Optional (timestamp, id) of the last transaction already seen,
+            only older transactions are returned
+        as_iterator: Stream the rows in chunks instead of caching them all,
+            uses a server-side cursor on PostgreSQL so it must be consumed
+            while the connection is still open
 
     Returns:
-        QuerySet: Ordered queryset of Transaction instances
+        QuerySet: Ordered queryset of Transaction instances, or an iterator
+        over them when as_iterator is set
 
     Raises:
         Http404: If user doesn't exist
     """
     user = get_object_or_404(User, user_id=telegram_user_id)
 
-    # Start with all user transactions, ordered by newest first
-    transactions = user.transactions.all().order_by('-timestamp')
-
-    # Apply filters if provided
+    # Collect the filters first so the queryset is only cloned once
+    conditions = models.Q()
     if transaction_type:
-        transactions = transactions.filter(transaction_type=transaction_type)
+        conditions &= models.Q(transaction_type=transaction_type)
 
     if currency:
         # Look for currency in both base_currency and to_currency (for swaps)
-        transactions = transactions.filter(
-            models.Q(base_currency=currency) |
-            models.Q(destination_currency=currency)
-        )
+        conditions &= _currency_q(currency)
+
+    if cursor is not None:
+        # Keyset pagination, id breaks ties between equal timestamps
+        timestamp, transaction_id = cursor
+        conditions &= (models.Q(timestamp__lt=timestamp) |
+                       models.Q(timestamp=timestamp, id__lt=transaction_id))
+
+    # User transactions, ordered by newest first
+    transactions = user.transactions.filter(conditions).order_by('-timestamp', '-id')
 
     # Apply pagination if provided
     if offset is not None:
+        warnings.warn("offset is deprecated, paginate with cursor instead",
+                      DeprecationWarning, stacklevel=2)
         transactions = transactions[offset:]
     if limit is not None:
         transactions = transactions[:limit]
 
+    if as_iterator:
+        return transactions.iterator(chunk_size=TRANSACTION_CHUNK_SIZE)
     return transactions